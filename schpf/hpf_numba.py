@@ -3,10 +3,7 @@
 import ctypes
 import numpy as np
 from scipy.sparse import coo_matrix
-try:
-    from scipy.misc import logsumexp
-except ImportError:
-    from scipy.special import logsumexp
+from scipy.special import logsumexp
 
 import numba
 from numba.extending import get_cython_function_address as getaddr
@@ -21,13 +18,37 @@ gammaln_fnaddr = getaddr("scipy.special.cython_special", "gammaln")
 gammaln_ftype = ctypes.CFUNCTYPE(ctypes.c_double, ctypes.c_double)
 cgammaln = gammaln_ftype(gammaln_fnaddr)
 
-@numba.njit(parallel=True, nogil=True, fastmath=True)
-def compute_pois_llh(X_data, X_row, X_col,
-                     theta_vi_shape, theta_vi_rate,
-                     beta_vi_shape, beta_vi_rate):
+def _compute_pois_llh(X_data, X_row, X_col,
+                      theta_vi_shape, theta_vi_rate,
+                      beta_vi_shape, beta_vi_rate,
+                      log_factorial):
+    """Poisson log-likelihood of each nonzero value
+
+    Parameters
+    ----------
+    X_data : ndarray of np.int32
+        (number_nonzero, ) array of nonzero values
+    X_row : ndarray of np.int32
+        (number_nonzero, ) array of row ids for each nonzero value
+    X_col : ndarray (np.int32)
+        (number_nonzero, ) array of column ids for each nonzero value
+    theta_vi_shape : ndarray
+        (ncells, nfactors) array of values for theta's variational shape
+    theta_vi_rate : ndarray
+        (ncells, nfactors) array of values for theta's variational rate
+    beta_vi_shape : ndarray
+        (ngenes, nfactors) array of values for beta's variational shape
+    beta_vi_rate : ndarray
+        (ngenes, nfactors) array of values for beta's variational rate
+    log_factorial : ndarray
+        Array where log_factorial[n] = log(n!), for n up to at least
+        max(X_data), to look up log(X_data!) for integer data. If empty,
+        log(X_data!) is computed with gammaln for every nonzero value.
+    """
     ncells, ngenes = (theta_vi_shape.shape[0], beta_vi_shape.shape[0])
     nfactors, nnz = (theta_vi_shape.shape[1], X_data.shape[0])
     dtype = theta_vi_shape.dtype
+    use_table = log_factorial.shape[0] > 0
 
     # precompute expectations
     theta_e_x = np.zeros_like(theta_vi_shape, dtype=dtype)
@@ -43,14 +64,107 @@ def compute_pois_llh(X_data, X_row, X_col,
     # compute llh
     llh = np.zeros(X_data.shape, dtype=dtype)
     for i in numba.prange(nnz):
-        e_rate = np.zeros(1, dtype=dtype)[0]
+        e_rate = 0.0
         for k in range(nfactors):
             e_rate += theta_e_x[X_row[i],k] * beta_e_x[X_col[i], k]
-        llh[i] = X_data[i] * np.log(e_rate) - e_rate \
-            - cgammaln(X_data[i] + 1.0)
+        if use_table:
+            log_x_factorial = log_factorial[int(X_data[i])]
+        else:
+            log_x_factorial = cgammaln(X_data[i] + 1.0)
+        llh[i] = X_data[i] * np.log(e_rate) - e_rate - log_x_factorial
+    return llh
+
+
+def _compute_pois_llh_sum(X_data, X_indices, X_indptr,
+                          theta_vi_shape, theta_vi_rate,
+                          beta_vi_shape, beta_vi_rate):
+    """Sum of the model-dependent terms of the Poisson log-likelihood of
+    nonzero values in CSR format
+
+    Computes the sum of X * log(e_rate) - e_rate, excluding log(X!) which
+    doesn't depend on the model, without storing pointwise values.
+
+    Parameters
+    ----------
+    X_data : ndarray of np.int32
+        (number_nonzero, ) array of nonzero values, in CSR order
+    X_indices : ndarray of np.int32
+        (number_nonzero, ) array of column ids for each nonzero value
+    X_indptr : ndarray of np.int32
+        (ncells + 1, ) array of row pointers into `X_data` and `X_indices`
+    theta_vi_shape : ndarray
+        (ncells, nfactors) array of values for theta's variational shape
+    theta_vi_rate : ndarray
+        (ncells, nfactors) array of values for theta's variational rate
+    beta_vi_shape : ndarray
+        (ngenes, nfactors) array of values for beta's variational shape
+    beta_vi_rate : ndarray
+        (ngenes, nfactors) array of values for beta's variational rate
+    """
+    ncells, ngenes = (theta_vi_shape.shape[0], beta_vi_shape.shape[0])
+    nfactors = theta_vi_shape.shape[1]
+    dtype = theta_vi_shape.dtype
+
+    # precompute expectations
+    beta_e_x = np.zeros_like(beta_vi_shape, dtype=dtype)
+    for i in numba.prange(ngenes):
+        for k in range(nfactors):
+            beta_e_x[i,k] = beta_vi_shape[i,k] / beta_vi_rate[i,k]
+
+    # compute llh, one row (cell) at a time
+    llh = 0.0
+    for i in numba.prange(ncells):
+        theta_e_x = np.zeros((nfactors), dtype=dtype)
+        for k in range(nfactors):
+            theta_e_x[k] = theta_vi_shape[i,k] / theta_vi_rate[i,k]
+
+        row_llh = 0.0
+        for p in range(X_indptr[i], X_indptr[i+1]):
+            j = X_indices[p]
+            e_rate = 0.0
+            for k in range(nfactors):
+                e_rate += theta_e_x[k] * beta_e_x[j,k]
+            row_llh += X_data[p] * np.log(e_rate) - e_rate
+        llh += row_llh
     return llh
 
 
+# prange is equivalent to range when parallel=False
+compute_pois_llh_table = numba.njit(parallel=True, nogil=True,
+        fastmath=True)(_compute_pois_llh)
+compute_pois_llh_table_serial = numba.njit(nogil=True, fastmath=True)(
+        _compute_pois_llh)
+compute_pois_llh_sum = numba.njit(parallel=True, nogil=True, fastmath=True)(
+        _compute_pois_llh_sum)
+compute_pois_llh_sum_serial = numba.njit(nogil=True, fastmath=True)(
+        _compute_pois_llh_sum)
+
+# an empty log factorial table, to use gammaln instead
+_NO_LOG_FACTORIAL_TABLE = np.zeros(0)
+
+
+def compute_pois_llh(X_data, X_row, X_col,
+                     theta_vi_shape, theta_vi_rate,
+                     beta_vi_shape, beta_vi_rate):
+    """Poisson log-likelihood of each nonzero value, computing log(X_data!)
+    with gammaln
+
+    See `_compute_pois_llh` for parameters
+    """
+    return compute_pois_llh_table(X_data, X_row, X_col,
+            theta_vi_shape, theta_vi_rate, beta_vi_shape, beta_vi_rate,
+            _NO_LOG_FACTORIAL_TABLE)
+
+
+def compute_pois_llh_serial(X_data, X_row, X_col,
+                            theta_vi_shape, theta_vi_rate,
+                            beta_vi_shape, beta_vi_rate):
+    """Single-threaded version of `compute_pois_llh`"""
+    return compute_pois_llh_table_serial(X_data, X_row, X_col,
+            theta_vi_shape, theta_vi_rate, beta_vi_shape, beta_vi_rate,
+            _NO_LOG_FACTORIAL_TABLE)
+
+
 @numba.njit(parallel=True, nogil=True)
 def compute_Xphi_data(X_data, X_row, X_col,
                      theta_vi_shape, theta_vi_rate,
@@ -114,15 +228,74 @@ def compute_Xphi_data(X_data, X_row, X_col,
     return Xphi
 
 
-def compute_Xphi_data_numpy(X, theta, beta, theta_ix=None):
+def compute_Xphi_data_numpy(X, theta, beta, theta_ix=None, out=None):
     """Single-threaded version of compute_Xphi_data
+
+    `X` may be a coo_matrix or a csr_matrix, and the result is in the order
+    of its nonzero values. If given, the result is written to `out`, an
+    (X.nnz, nfactors) array
+    """
+    if X.format == 'csr':
+        return compute_Xphi_data_numpy_csr(X.data, X.indices, X.indptr,
+                theta, beta, theta_ix=theta_ix, out=out)
+    theta_e_logx, beta_e_logx = theta.e_logx, beta.e_logx
+    if theta_ix is not None:
+        theta_e_logx = theta_e_logx[theta_ix,:]
+    # mode='clip' so out isn't buffered (indices are all valid)
+    logrho = np.take(beta_e_logx, X.col, axis=0, out=out, mode='clip')
+    logrho += theta_e_logx[X.row, :]
+    logrho -= logsumexp(logrho, axis=1)[:,None]
+    np.exp(logrho, out=logrho)
+    logrho *= X.data[:,None]
+    return logrho
+
+
+def compute_Xphi_data_numpy_csr(X_data, X_indices, X_indptr, theta, beta,
+        theta_ix=None, out=None):
+    """Single-threaded version of compute_Xphi_data for data in CSR format
+
+    Takes the arrays of a csr_matrix rather than the matrix, so a block of
+    rows can be passed as views without building a new matrix.
+
+    Parameters
+    ----------
+    X_data : ndarray
+        (number_nonzero, ) array of nonzero values, in CSR order
+    X_indices : ndarray
+        (number_nonzero, ) array of column ids for each nonzero value
+    X_indptr : ndarray
+        (nrows + 1, ) array of row pointers into `X_data` and `X_indices`.
+        Need not start at 0.
+    theta : HPF_Gamma
+    beta : HPF_Gamma
+    theta_ix : slice or ndarray, optional (Default: None)
+        Rows of theta for each row of the data. The first nrows of theta if
+        not given.
+    out : ndarray, optional (Default: None)
+        (number_nonzero, nfactors) array to write the result to
+    """
+    return _compute_Xphi_data_numpy_csr(X_data, X_indices, X_indptr,
+            theta.e_logx, beta.e_logx, theta_ix=theta_ix, out=out)
+
+
+def _compute_Xphi_data_numpy_csr(X_data, X_indices, X_indptr,
+        theta_e_logx, beta_e_logx, theta_ix=None, out=None):
+    """`compute_Xphi_data_numpy_csr` from theta's and beta's e_logx
+
+    For callers that already have e_logx, such as _fit's cached values
     """
-    if theta_ix is None:
-        logrho = theta.e_logx[X.row, :] + beta.e_logx[X.col, :]
-    else:
-        logrho = theta.e_logx[theta_ix,:][X.row, :] + beta.e_logx[X.col,:]
-    logphi = logrho - logsumexp(logrho, axis=1)[:,None]
-    return X.data[:,None] * np.exp(logphi)
+    nrows = X_indptr.shape[0] - 1
+    theta_e_logx = theta_e_logx[:nrows] if theta_ix is None \
+            else theta_e_logx[theta_ix,:]
+    # mode='clip' so out isn't buffered (indices are all valid)
+    logrho = np.take(beta_e_logx, X_indices, axis=0, out=out, mode='clip')
+    # repeat each row's theta for its nonzeros, rather than expanding the
+    # row pointers and gathering
+    logrho += np.repeat(theta_e_logx, np.diff(X_indptr), axis=0)
+    logrho -= logsumexp(logrho, axis=1)[:,None]
+    np.exp(logrho, out=logrho)
+    logrho *= X_data[:,None]
+    return logrho
 
 
 @numba.njit(fastmath=True) #results unstable with prange. don't do it.
@@ -156,6 +329,299 @@ def compute_loading_shape_update(Xphi_data, X_keep, nkeep, shape_prior):
     return result
 
 
+@numba.njit(fastmath=True)
+def accumulate_loading_shape_update(Xphi_data, X_keep, result):
+    """Add X * phi to gamma shape updates for theta or beta in place
+
+    Like `compute_loading_shape_update`, but for adding blocks of
+    `Xphi_data` to `result` one at a time
+
+    Parameters
+    ----------
+    Xphi_data : ndarray
+        (number_nonzero, nfactors) array of X * phi
+    X_keep : ndarray
+        (number_nonzer,) vector of indices along the axis of interest
+    result : ndarray
+        (nkeep, nfactors) array of shape updates to add to
+    """
+    nnz, nfactors = Xphi_data.shape
+    for i in range(nnz):
+        ikeep = X_keep[i]
+        for k in range(nfactors):
+            result[ikeep, k] += Xphi_data[i,k]
+
+
+def _compute_loading_shape_update_compressed(Xphi_data, X_indptr,
+        shape_prior):
+    """Compute gamma shape updates for theta or beta from compressed data
+
+    Each item's update is the sum of a contiguous segment of `Xphi_data`,
+    so no scatter over `Xphi_data`'s rows is needed.
+
+    Parameters
+    ----------
+    Xphi_data : ndarray
+        (number_nonzero, nfactors) array of X * phi, in CSR order when
+        computing updates for theta and CSC order for beta
+    X_indptr : ndarray
+        (nkeep + 1,) array of pointers into the rows of `Xphi_data`. The
+        indptr of X in CSR format when computing updates for theta, and in
+        CSC format when computing updates for beta
+    shape_prior : float
+        Hyperprior for parameter. a for theta, c for beta.
+
+    """
+    nkeep, nfactors = X_indptr.shape[0] - 1, Xphi_data.shape[1]
+    dtype = Xphi_data.dtype
+
+    result = shape_prior * np.ones((nkeep, nfactors), dtype=dtype)
+    # each item's segment is summed by one thread
+    for i in numba.prange(nkeep):
+        for p in range(X_indptr[i], X_indptr[i+1]):
+            for k in range(nfactors):
+                result[i, k] += Xphi_data[p,k]
+    return result
+
+
+# prange is equivalent to range when parallel=False
+compute_loading_shape_update_compressed = numba.njit(parallel=True,
+        nogil=True, fastmath=True)(_compute_loading_shape_update_compressed)
+compute_loading_shape_update_compressed_serial = numba.njit(nogil=True,
+        fastmath=True)(_compute_loading_shape_update_compressed)
+
+
+@numba.njit(parallel=True, nogil=True)
+def compute_e_logx(vi_shape, vi_rate):
+    """Expectation of the log of variational Gammas using numba
+
+    Parameters
+    ----------
+    vi_shape : ndarray
+        (nitems, nfactors) array of variational shapes
+    vi_rate : ndarray
+        (nitems, nfactors) array of variational rates
+    """
+    result = np.zeros_like(vi_shape)
+    for i in numba.prange(vi_shape.shape[0]):
+        for k in range(vi_shape.shape[1]):
+            result[i,k] = psi(vi_shape[i,k]) - np.log(vi_rate[i,k])
+    return result
+
+
+def _compute_e_x_sums(vi_shape, vi_rate, nchunks=64):
+    """Sums of the expectations of variational Gammas over factors and over
+    items, without storing the expectations
+
+    Parameters
+    ----------
+    vi_shape : ndarray
+        (nitems, nfactors) array of variational shapes
+    vi_rate : ndarray
+        (nitems, nfactors) array of variational rates
+    nchunks : int, optional (Default: 64)
+        Number of blocks of items to compute partial sums over factors for
+        in parallel
+
+    Returns
+    -------
+    item_sums : ndarray
+        (nitems,) sum of expectations over factors for each item
+    factor_sums : ndarray
+        (nfactors,) sum of expectations over items for each factor
+    """
+    nitems, nfactors = vi_shape.shape
+    nchunks = max(1, min(nchunks, nitems))
+
+    item_sums = np.zeros((nitems), dtype=vi_shape.dtype)
+    partial_factor_sums = np.zeros((nchunks, nfactors), dtype=vi_shape.dtype)
+    for c in numba.prange(nchunks):
+        for i in range(c * nitems // nchunks, (c + 1) * nitems // nchunks):
+            for k in range(nfactors):
+                e_x = vi_shape[i,k] / vi_rate[i,k]
+                item_sums[i] += e_x
+                partial_factor_sums[c,k] += e_x
+
+    factor_sums = np.zeros((nfactors), dtype=vi_shape.dtype)
+    for c in range(nchunks):
+        for k in range(nfactors):
+            factor_sums[k] += partial_factor_sums[c,k]
+    return item_sums, factor_sums
+
+
+# prange is equivalent to range when parallel=False
+compute_e_x_sums = numba.njit(parallel=True, nogil=True, fastmath=True)(
+        _compute_e_x_sums)
+compute_e_x_sums_serial = numba.njit(nogil=True, fastmath=True)(
+        _compute_e_x_sums)
+
+
+@numba.njit(parallel=True, nogil=True, fastmath=True)
+def compute_loading_shape_update_fused(X_data, X_indices, X_indptr,
+        loading_e_logx, other_loading_e_logx, shape_prior):
+    """Compute gamma shape updates for theta or beta directly from data
+
+    Fuses `compute_Xphi_data` with `compute_loading_shape_update_compressed`,
+    so that X * phi is accumulated for each item as it is computed and never
+    stored.
+
+    Parameters
+    ----------
+    X_data : ndarray of np.int32
+        (number_nonzero, ) array of nonzero values. In CSR order when
+        computing updates for theta and CSC order for beta
+    X_indices : ndarray of np.int32
+        (number_nonzero, ) array of indices along the other axis for each
+        nonzero value. Column ids (genes) for theta, row ids (cells) for beta
+    X_indptr : ndarray of np.int32
+        (nkeep + 1,) array of pointers into `X_data` and `X_indices`
+    loading_e_logx : ndarray
+        (nkeep, nfactors) expectation of log of the loading being updated.
+        theta when computing updates for theta, beta for beta.
+    other_loading_e_logx : ndarray
+        expectation of log of the other loading.  beta when computing updates
+        for theta, theta for beta.
+    shape_prior : float
+        Hyperprior for parameter. a for theta, c for beta.
+
+    Returns
+    -------
+    result : ndarray
+        (nkeep, nfactors) shape updates, with the same dtype as
+        `loading_e_logx`
+    """
+    nkeep, nfactors = X_indptr.shape[0] - 1, loading_e_logx.shape[1]
+    # keep arithmetic in the loadings' dtype, so float32 models get float32
+    # exp. Subtracting the largest input before exponentiating keeps this
+    # stable.
+    dtype = loading_e_logx.dtype
+
+    result = np.zeros((nkeep, nfactors), dtype=dtype)
+    for i in numba.prange(nkeep):
+        accumulator = np.zeros((nfactors), dtype=dtype)
+        accumulator[:] = shape_prior
+        rho_shift = np.zeros((nfactors), dtype=dtype)
+        # zero of dtype, so the normalizer's sum stays in dtype
+        zero = np.zeros(1, dtype=dtype)[0]
+        for p in range(X_indptr[i], X_indptr[i+1]):
+            j = X_indices[p]
+
+            #log normalizer trick
+            largest_in = loading_e_logx[i,0] + other_loading_e_logx[j,0]
+            for k in range(1, nfactors):
+                largest_in = max(largest_in,
+                        loading_e_logx[i,k] + other_loading_e_logx[j,k])
+            normalizer = zero
+            for k in range(nfactors):
+                rho_shift[k] = np.exp(loading_e_logx[i,k]
+                        + other_loading_e_logx[j,k] - largest_in)
+                normalizer += rho_shift[k]
+
+            # int32 / float32 promotes to float64, so cast back
+            x_over_normalizer = dtype.type(X_data[p] / normalizer)
+            for k in range(nfactors):
+                accumulator[k] += x_over_normalizer * rho_shift[k]
+
+        for k in range(nfactors):
+            result[i,k] = accumulator[k]
+    return result
+
+
+@numba.njit(parallel=True, nogil=True, fastmath=True)
+def compute_shape_updates_fused(X_data, X_indices, X_indptr,
+        theta_e_logx, beta_e_logx, a, c, block_rows, beta_partial):
+    """Compute gamma shape updates for both theta and beta directly from
+    data in CSR format
+
+    Like `compute_loading_shape_update_fused` for theta, but each X * phi
+    is also added to the update for its gene, so phi is computed once per
+    nonzero value for both loadings. Each block of cells is scattered into
+    its own partial sums for beta in `beta_partial`, which are reduced at the
+    end.
+
+    Parameters
+    ----------
+    X_data : ndarray of np.int32
+        (number_nonzero, ) array of nonzero values, in CSR order
+    X_indices : ndarray of np.int32
+        (number_nonzero, ) array of column ids (genes) for each nonzero value
+    X_indptr : ndarray of np.int32
+        (ncells + 1,) array of row pointers into `X_data` and `X_indices`
+    theta_e_logx : ndarray
+        (ncells, nfactors) expectation of log of theta
+    beta_e_logx : ndarray
+        (ngenes, nfactors) expectation of log of beta
+    a : float
+        Hyperprior for theta
+    c : float
+        Hyperprior for beta
+    block_rows : ndarray
+        (nblocks + 1,) increasing row ids from 0 to ncells, such that block b
+        is cells block_rows[b] to block_rows[b+1]. Blocks are computed in
+        parallel, so typically there is one per thread, with about the same
+        number of nonzero values each (see `util.compressed_tiles`).
+    beta_partial : ndarray
+        (nblocks or more, ngenes, nfactors) scratch array for each block's
+        partial sums for beta, overwritten. Can be reused between calls.
+
+    Returns
+    -------
+    theta_shape : ndarray
+        (ncells, nfactors) shape updates for theta
+    beta_shape : ndarray
+        (ngenes, nfactors) shape updates for beta
+    """
+    ncells = X_indptr.shape[0] - 1
+    ngenes, nfactors = beta_e_logx.shape
+    dtype = theta_e_logx.dtype
+    nblocks = block_rows.shape[0] - 1
+    if beta_partial.shape[0] < nblocks:
+        raise ValueError('beta_partial must have a row for each block')
+
+    theta_shape = np.zeros((ncells, nfactors), dtype=dtype)
+    for b in numba.prange(nblocks):
+        for j in range(ngenes):
+            for k in range(nfactors):
+                beta_partial[b,j,k] = 0
+        accumulator = np.zeros((nfactors), dtype=dtype)
+        rho_shift = np.zeros((nfactors), dtype=dtype)
+        # zero of dtype, so the normalizer's sum stays in dtype
+        zero = np.zeros(1, dtype=dtype)[0]
+        for i in range(block_rows[b], block_rows[b+1]):
+            accumulator[:] = a
+            for p in range(X_indptr[i], X_indptr[i+1]):
+                j = X_indices[p]
+
+                #log normalizer trick
+                largest_in = theta_e_logx[i,0] + beta_e_logx[j,0]
+                for k in range(1, nfactors):
+                    largest_in = max(largest_in,
+                            theta_e_logx[i,k] + beta_e_logx[j,k])
+                normalizer = zero
+                for k in range(nfactors):
+                    rho_shift[k] = np.exp(theta_e_logx[i,k]
+                            + beta_e_logx[j,k] - largest_in)
+                    normalizer += rho_shift[k]
+
+                # int32 / float32 promotes to float64, so cast back
+                x_over_normalizer = dtype.type(X_data[p] / normalizer)
+                for k in range(nfactors):
+                    xphi = x_over_normalizer * rho_shift[k]
+                    accumulator[k] += xphi
+                    beta_partial[b,j,k] += xphi
+
+            for k in range(nfactors):
+                theta_shape[i,k] = accumulator[k]
+
+    beta_shape = np.zeros((ngenes, nfactors), dtype=dtype)
+    for j in numba.prange(ngenes):
+        for k in range(nfactors):
+            beta_shape[j,k] = c
+            for block in range(nblocks):
+                beta_shape[j,k] += beta_partial[block,j,k]
+    return theta_shape, beta_shape
+
+
 @numba.njit(fastmath=True)
 def compute_loading_rate_update(prior_vi_shape, prior_vi_rate,
         other_loading_vi_shape, other_loading_vi_rate,):
@@ -8,9 +8,13 @@ given dataset
 
 import functools
 import numpy as np
+from scipy.sparse import csr_matrix, isspmatrix_csr
 from scipy.special import gammaln
 
-from schpf.hpf_numba import compute_pois_llh
+from schpf.hpf_numba import compute_pois_llh, compute_pois_llh_serial
+from schpf.hpf_numba import compute_pois_llh_table
+from schpf.hpf_numba import compute_pois_llh_table_serial
+from schpf.hpf_numba import compute_pois_llh_sum, compute_pois_llh_sum_serial
 
 ### Higher order loss functions
 
@@ -34,6 +38,52 @@ def loss_function_for_data(loss_function, X):
     return functools.partial(loss_function, X=X)
 
 
+def mean_negative_pois_llh_for_data(X, single_process=False):
+    """ Get the mean negative Poisson log-likelihood for a fixed dataset
+
+    Gives the same loss as ``loss_function_for_data(mean_negative_pois_llh,
+    X)``, but the sum of log(X!) (which doesn't depend on the model) is
+    computed once up front, and each evaluation reduces straight to a scalar
+    rather than computing an llh for every nonzero value.
+
+    Parameters
+    ----------
+    X : sparse matrix
+        Data to compute the loss of. Converted to CSR format once, keeping
+        any duplicate entries (rather than summing them) so that every
+        stored value counts toward the mean, as in `mean_negative_pois_llh`.
+    single_process: bool, optional (Default: False)
+        use single-threaded version of llh
+
+    Returns
+    -------
+    fixed_data_loss_function : function
+        A loss function with the same parameters as `mean_negative_pois_llh`,
+        except for the data parameter `X` which is fixed
+    """
+    if isspmatrix_csr(X):
+        X_csr = X
+    else:
+        # X.tocsr() would sum duplicates, so order the entries by row here
+        X_coo = X.tocoo()
+        order = np.argsort(X_coo.row, kind='stable')
+        indptr = np.zeros(X_coo.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(X_coo.row, minlength=X_coo.shape[0]),
+                out=indptr[1:])
+        X_csr = csr_matrix((X_coo.data[order], X_coo.col[order], indptr),
+                shape=X_coo.shape)
+    log_factorial_sum = np.sum(gammaln(X_csr.data + 1.0))
+    llh_sum_function = compute_pois_llh_sum_serial if single_process \
+            else compute_pois_llh_sum
+
+    def _mean_negative_pois_llh(*, theta, beta, **kwargs):
+        llh_sum = llh_sum_function(X_csr.data, X_csr.indices, X_csr.indptr,
+                theta.vi_shape, theta.vi_rate, beta.vi_shape, beta.vi_rate)
+        return (log_factorial_sum - llh_sum) / X_csr.nnz
+
+    return _mean_negative_pois_llh
+
+
 def projection_loss_function(loss_function, X, nfactors,
         model_kwargs={}, proj_kwargs={}):
     """ Project new data onto an existing model and calculate loss from it
@@ -102,6 +152,29 @@ def projection_loss_function(loss_function, X, nfactors,
     return _projection_loss_function
 
 
+#### Helpers
+
+# largest count to build a log factorial table for (512KB of float64)
+_LOG_FACTORIAL_TABLE_MAX_COUNT = 2**16
+
+@functools.lru_cache(maxsize=8)
+def log_factorial_table(max_count):
+    """Table of log factorials
+
+    Parameters
+    ----------
+    max_count : int
+        Largest value to compute the log factorial of
+
+    Returns
+    -------
+    log_factorial : ndarray
+        (max_count + 1,) array where log_factorial[n] = log(n!). Cached and
+        shared between calls, so should not be modified.
+    """
+    return gammaln(np.arange(max_count + 1, dtype=np.float64) + 1)
+
+
 #### Loss functions
 
 def pois_llh_pointwise(X, *, theta, beta, single_process=False, **kwargs):
@@ -129,14 +202,24 @@ def pois_llh_pointwise(X, *, theta, beta, single_process=False, **kwargs):
     must be passed to the function as a keyword argument, and the function
     will accept unused keyword args.
     """
-    if single_process:
-        e_rate = (theta.e_x[X.row] *  beta.e_x[X.col]).sum(axis=1)
-        llh = X.data * np.log(e_rate) - e_rate - gammaln(X.data + 1)
+    max_count = int(X.data.max(initial=0)) \
+            if np.issubdtype(X.data.dtype, np.integer) else None
+    # counts usually have few distinct values, so look up log(X.data!),
+    # unless the table would be large or bigger than the data
+    if max_count is not None and max_count <= _LOG_FACTORIAL_TABLE_MAX_COUNT \
+            and max_count <= max(X.nnz, 1024):
+        llh_function = compute_pois_llh_table_serial if single_process \
+                else compute_pois_llh_table
+        return llh_function(X.data, X.row, X.col,
+                            theta.vi_shape, theta.vi_rate,
+                            beta.vi_shape, beta.vi_rate,
+                            log_factorial_table(max_count))
     else:
-        llh = compute_pois_llh(X.data, X.row, X.col,
-                                theta.vi_shape, theta.vi_rate,
-                                beta.vi_shape, beta.vi_rate)
-    return llh
+        llh_function = compute_pois_llh_serial if single_process \
+                else compute_pois_llh
+        return llh_function(X.data, X.row, X.col,
+                            theta.vi_shape, theta.vi_rate,
+                            beta.vi_shape, beta.vi_rate)
 
 
 def mean_negative_pois_llh(X, *, theta, beta, single_process=False, **kwargs):
@@ -1,16 +1,14 @@
 #!/usr/bin/env python
+from collections import deque
 from copy import deepcopy
 from warnings import warn
 from functools import partial
 from multiprocessing import cpu_count
 
 import numpy as np
+import numba
 from scipy.sparse import coo_matrix
 from scipy.special import digamma, gammaln, psi
-try:
-    from scipy.misc import logsumexp
-except ImportError:
-    from scipy.special import logsumexp
 
 from sklearn.base import BaseEstimator
 import joblib
@@ -19,11 +17,18 @@ from joblib import Parallel, delayed
 
 # TODO warn if can't import, and allow computation with slow
 from schpf.hpf_numba import *
-from schpf.util import minibatch_ix_generator
+from schpf.hpf_numba import _compute_Xphi_data_numpy_csr
+from schpf.util import minibatch_ix_generator, canonical_csr
+from schpf.util import compressed_tiles
 import schpf.loss as ls
 import schpf
 
 
+# target nonzeros per block when X * phi must be stored, so each block stays
+# in cache between computing it and reducing it (~640KB at 20 factors)
+_XPHI_TILE_NNZ = 4096
+
+
 class HPF_Gamma(object):
     """Gamma variational distributions
 
@@ -39,7 +44,11 @@ class HPF_Gamma(object):
     Attributes
     ----------
     vi_shape : ndarray
+        Setting invalidates cached values. Cached values are only used
+        while fitting, and are invalidated at the start of each fit, so
+        in-place modifications between fits are safe.
     vi_rate : ndarray
+        Same as `vi_shape`
     dims : ndarray
         The shape of vi_shape and vi_rate
     dtype : dtype
@@ -81,6 +90,27 @@ class HPF_Gamma(object):
         self.dtype = vi_shape.dtype
 
 
+    def __getstate__(self):
+        # don't save cached values or scratch buffers
+        state = self.__dict__.copy()
+        for key in ['_e_x_buf', '_e_logx_buf', '_e_x_valid', '_e_logx_valid']:
+            state.pop(key, None)
+        # save vi_shape and vi_rate under their public names, so saved models
+        # can still be loaded by older versions
+        for key in ['vi_shape', 'vi_rate']:
+            state[key] = state.pop('_' + key)
+        return state
+
+
+    def __setstate__(self, state):
+        # vi_shape and vi_rate are plain attributes in older saved models
+        for key in ['vi_shape', 'vi_rate']:
+            if key in state:
+                state['_' + key] = state.pop(key)
+        self.__dict__.update(state)
+        self._invalidate()
+
+
     def __eq__(self, other):
         if isinstance(other, self.__class__):
             shape_equal = np.array_equal(self.vi_shape, other.vi_shape)
@@ -90,6 +120,28 @@ class HPF_Gamma(object):
         return False
 
 
+    @property
+    def vi_shape(self):
+        return self._vi_shape
+
+
+    @vi_shape.setter
+    def vi_shape(self, val):
+        self._vi_shape = val
+        self._invalidate()
+
+
+    @property
+    def vi_rate(self):
+        return self._vi_rate
+
+
+    @vi_rate.setter
+    def vi_rate(self, val):
+        self._vi_rate = val
+        self._invalidate()
+
+
     @property
     def dims(self):
         assert self.vi_shape.shape == self.vi_rate.shape
@@ -108,15 +160,87 @@ class HPF_Gamma(object):
     def e_logx(self):
         """Expectation of the log of random variable given variational
         distribution(s)"""
-        return digamma(self.vi_shape) - np.log(self.vi_rate)
+        result = digamma(self.vi_shape)
+        result -= np.log(self.vi_rate)
+        return result
+
+
+    def cached_e_x(self):
+        """`e_x`, only recomputed after the variational distributions change
+
+        Returns
+        -------
+        e_x : ndarray
+            Expected value of the random variable(s) given variational
+            distribution(s). Shared between calls (and overwritten when
+            recomputed), so should not be modified.
+        """
+        if not self._e_x_valid:
+            np.divide(self.vi_shape, self.vi_rate,
+                    out=self._buffer('_e_x_buf'))
+            self._e_x_valid = True
+        return self._e_x_buf
+
+
+    def cached_e_logx(self):
+        """`e_logx`, only recomputed after the variational distributions
+        change
+
+        Returns
+        -------
+        e_logx : ndarray
+            Expectation of the log of random variable given variational
+            distribution(s). Shared between calls (and overwritten when
+            recomputed), so should not be modified.
+        """
+        if not self._e_logx_valid:
+            e_logx = self._buffer('_e_logx_buf')
+            digamma(self.vi_shape, out=e_logx)
+            e_logx -= np.log(self.vi_rate)
+            self._e_logx_valid = True
+        return self._e_logx_buf
+
+
+    def _invalidate(self):
+        """Mark values cached from vi_shape and vi_rate as stale"""
+        self._e_x_valid = False
+        self._e_logx_valid = False
+
+
+    def _release(self):
+        """Free cached values, so they don't outlive a fit"""
+        self._invalidate()
+        for name in ['_e_x_buf', '_e_logx_buf']:
+            self.__dict__.pop(name, None)
+
+
+    def _buffer(self, name):
+        """Get a persistent array with vi_shape's shape and dtype
+
+        Allocated on first use (or if vi_shape's shape or dtype has changed)
+        and contents are arbitrary.
+        """
+        buf = getattr(self, name, None)
+        if buf is None or buf.shape != self.vi_shape.shape \
+                or buf.dtype != self.vi_shape.dtype:
+            buf = np.empty_like(self.vi_shape)
+            setattr(self, name, buf)
+        return buf
 
 
     @property
     def entropy(self):
         """Entropy of variational Gammas"""
-        return  self.vi_shape - np.log(self.vi_rate) \
-                + gammaln(self.vi_shape) \
-                + (1 - self.vi_shape) * digamma(self.vi_shape)
+        result = np.log(self.vi_rate)
+        np.subtract(self.vi_shape, result, out=result)
+        tmp = gammaln(self.vi_shape)
+        result += tmp
+        # (1 - vi_shape) * digamma(vi_shape)
+        digamma(self.vi_shape, out=tmp)
+        result += tmp
+        tmp *= self.vi_shape
+        result -= tmp
+        return result
 
 
     def sample(self, nsamples=1):
@@ -133,10 +257,11 @@ class HPF_Gamma(object):
             An ndarray of samples from the variational distributions, where
             the last dimension is the number of samples `nsamples`
         """
-        samples = []
-        for i in range(nsamples):
-            samples.append(np.random.gamma(self.vi_shape, 1/self.vi_rate).T)
-        return np.stack(samples).T
+        # draw unit-rate gammas in the final shape, then scale in place
+        samples = np.random.standard_gamma(self.vi_shape[..., None],
+                size=self.dims + (nsamples,))
+        samples /= self.vi_rate[..., None]
+        return samples
 
 
     def combine(self, other, other_ixs):
@@ -427,7 +552,7 @@ class scHPF(BaseEstimator):
 
         Parameters
         ----------
-        X: coo_matrix
+        X: coo_matrix or csr_matrix
             Data to fit
         loss_function : function, optional (Default: None)
             loss function to use for fit. set to negative poisson likelihood
@@ -532,8 +657,8 @@ class scHPF(BaseEstimator):
 
         Parameters
         ----------
-        X: coo_matrix
-            Data to fit
+        X: coo_matrix or csr_matrix
+            Data to fit. Not modified.
         freeze_genes: bool, (optional, default False)
             Should we update gene variational distributions eta and beta
         reinit: bool, (optional, default True)
@@ -603,25 +728,36 @@ class scHPF(BaseEstimator):
             loss at each checkstep
         """
         assert loss_smoothing > 0
+        # row-major (cells) layout of the data, so shape updates for theta
+        # reduce over contiguous nonzeros. X's row and column arrays aren't
+        # needed after this.
+        X_csr = canonical_csr(_counts_as_int32(X))
+        del X
 
         # local (convenience) vars for model
-        nfactors, (ncells, ngenes) = self.nfactors, X.shape
+        nfactors, (ncells, ngenes) = self.nfactors, X_csr.shape
         a, ap, c, cp = self.a, self.ap, self.c, self.cp
 
         # get empirically set hyperparameters and variational distributions
-        bp, dp, xi, eta, theta, beta = self._setup(X, freeze_genes, reinit)
+        bp, dp, xi, eta, theta, beta = self._setup(X_csr, freeze_genes,
+                reinit)
+        # distributions may have been modified in place since they were cached
+        for distribution in (xi, eta, theta, beta):
+            distribution._invalidate()
 
         # Make first updates for hierarchical shape prior
         # (vi_shape is constant, but want to update full distribution)
         xi.vi_shape[:] = ap + nfactors * a
+        xi._invalidate()
         if not freeze_genes:
             eta.vi_shape[:] = cp + nfactors * c
+            eta._invalidate()
 
         # setup loss function as mean negative llh of nonzero training data
         # if the loss function is not given
         if loss_function is None:
-            loss_function = ls.loss_function_for_data(
-                    ls.mean_negative_pois_llh, X)
+            loss_function = ls.mean_negative_pois_llh_for_data(X_csr,
+                    single_process=single_process)
 
         # setup batch_ix iterator
         if batchsize is not None and batchsize > 1 and batchsize <= ncells:
@@ -632,87 +768,187 @@ class scHPF(BaseEstimator):
             batch_ix_generator = None
 
         ## init
-        loss, unsmoothed_loss, pct_change = [], [], []
+        loss = []
+        # only the recent history is needed for smoothing and convergence
+        unsmoothed_loss = deque(maxlen=loss_smoothing)
+        pct_change = deque(maxlen=2)
+        # reused for blocks of Xphi_data when it must be stored
+        Xphi_buf = None
+        # reused for partial sums of beta's shape updates in the fused kernel
+        beta_partial_buf = None
         # check variable overrides
         min_iter = self.min_iter if min_iter is None else min_iter
         max_iter = self.max_iter if max_iter is None else max_iter
         epsilon = self.epsilon if epsilon is None else epsilon
         check_freq = self.check_freq if check_freq is None else check_freq
         verbose = self.verbose if verbose is None else verbose
+        better_than_n_ago = self.better_than_n_ago
+
+        # don't start numba threads for single process fits
+        e_x_sums = compute_e_x_sums_serial if single_process \
+                else compute_e_x_sums
+        # beta's expectations summed over factors (for eta) and over genes
+        # (for theta), updated with beta. Constant when genes are frozen.
+        beta_e_x_gene_sums, beta_e_x_factor_sums = e_x_sums(
+                beta.vi_shape, beta.vi_rate)
+        # theta's expectations summed over cells (for beta), updated with
+        # theta. Over the last batch's cells when batched.
+        _, theta_e_x_factor_sums = e_x_sums(theta.vi_shape, theta.vi_rate)
+
+        def update_cells(batch_ix, theta_vi_shape):
+            """Update theta and xi for the cells in batch_ix
+
+            Returns theta's expectations for the cells in batch_ix, summed
+            over cells
+            """
+            theta.vi_shape[batch_ix] = theta_vi_shape
+            # outer sum of xi's expectations and beta's summed expectations
+            xi_e_x = xi.cached_e_x()[batch_ix, None]
+            if batched:
+                theta.vi_rate[batch_ix] = xi_e_x + beta_e_x_factor_sums
+            else:
+                np.add(xi_e_x, beta_e_x_factor_sums, out=theta.vi_rate)
+            theta._invalidate()
+            # xi's rate from theta's expectations summed over factors
+            theta_e_x_cell_sums, theta_e_x_factor_sums = e_x_sums(
+                    theta.vi_shape[batch_ix], theta.vi_rate[batch_ix])
+            if batched:
+                xi.vi_rate[batch_ix] = bp + theta_e_x_cell_sums
+            else:
+                np.add(theta_e_x_cell_sums, bp, out=xi.vi_rate)
+            xi._invalidate()
+            return theta_e_x_factor_sums
+
         for t in range(max_iter):
             # setup batching
             if batch_ix_generator is None:
-                batch_ix = np.arange(X.shape[0])
-                batchsize = ncells
-                X_batch = X
+                # a slice, so indexing with batch_ix gives views
+                batch_ix = slice(None)
+                Xb_csr = X_csr
             else:
                 batch_ix = next(batch_ix_generator)
-                X_batch = X.tocsr()[batch_ix,:].tocoo()
-
-            if t==0 and reinit: #randomize phi for first iteration
-                random_phi = np.random.dirichlet( np.ones(nfactors),
-                        X_batch.data.shape[0])
-                Xphi_data = X_batch.data[:,None] * random_phi
+                Xb_csr = X_csr[batch_ix,:]
+
+            # shape updates for theta and beta only depend on phi, so compute
+            # both before any assignments
+            if (t==0 and reinit) or single_process:
+                # store Xphi_data for a block of rows (cells) at a time
+                tvs = np.empty((Xb_csr.shape[0], nfactors),
+                        dtype=theta.dtype)
+                if not freeze_genes:
+                    bvs = np.full((ngenes, nfactors), c, dtype=beta.dtype)
+                tiles = compressed_tiles(Xb_csr.indptr, _XPHI_TILE_NNZ)
+                tiles_nnz = Xb_csr.indptr[tiles]
+                max_tile_nnz = np.max(np.diff(tiles_nnz), initial=0)
+                if Xphi_buf is None or Xphi_buf.shape[0] < max_tile_nnz:
+                    Xphi_buf = np.empty((max_tile_nnz, nfactors),
+                            dtype=theta.dtype)
+                if not (t==0 and reinit):
+                    theta_e_logx = theta.cached_e_logx()
+                    beta_e_logx = beta.cached_e_logx()
+                for r0, r1, p0, p1 in zip(tiles[:-1], tiles[1:],
+                        tiles_nnz[:-1], tiles_nnz[1:]):
+                    Xphi_data = Xphi_buf[:p1-p0]
+                    # views of the tile's nonzeros, rather than a new matrix
+                    tile_data = Xb_csr.data[p0:p1]
+                    tile_indices = Xb_csr.indices[p0:p1]
+                    tile_indptr = Xb_csr.indptr[r0:r1+1] - p0
+                    if t==0 and reinit: #randomize phi for first iteration
+                        Xphi_data[:] = np.random.dirichlet(np.ones(nfactors),
+                                p1 - p0)
+                        Xphi_data *= tile_data[:,None]
+                    else:
+                        tile_ix = batch_ix[r0:r1] if batched \
+                                else slice(r0, r1)
+                        _compute_Xphi_data_numpy_csr(tile_data,
+                                tile_indices, tile_indptr, theta_e_logx,
+                                beta_e_logx, theta_ix=tile_ix, out=Xphi_data)
+                    if single_process:
+                        tvs[r0:r1] = \
+                                compute_loading_shape_update_compressed_serial(
+                                        Xphi_data, tile_indptr, a)
+                    else:
+                        tvs[r0:r1] = compute_loading_shape_update_compressed(
+                                Xphi_data, tile_indptr, a)
+                    if not freeze_genes:
+                        # scatter by gene rather than copying Xphi_data to
+                        # CSC order
+                        accumulate_loading_shape_update(Xphi_data,
+                                tile_indices, bvs)
             else:
-                if single_process:
-                    Xphi_data = compute_Xphi_data_numpy(X_batch, theta, beta,
-                            theta_ix=batch_ix)
+                # accumulate Xphi_data over rows (cells) and columns (genes)
+                # as it is computed, without storing it
+                if batched:
+                    theta_e_logx = compute_e_logx(theta.vi_shape[batch_ix],
+                            theta.vi_rate[batch_ix])
+                else:
+                    theta_e_logx = theta.cached_e_logx()
+                # only computed once when genes are frozen
+                beta_e_logx = beta.cached_e_logx()
+                if freeze_genes:
+                    tvs = compute_loading_shape_update_fused(Xb_csr.data,
+                            Xb_csr.indices, Xb_csr.indptr,
+                            theta_e_logx, beta_e_logx, a)
                 else:
-                    Xphi_data = compute_Xphi_data(
-                            X_batch.data, X_batch.row, X_batch.col,
-                            theta.vi_shape[batch_ix], theta.vi_rate[batch_ix],
-                            beta.vi_shape, beta.vi_rate)
+                    if beta_partial_buf is None:
+                        # one block per thread in use. Reducing the blocks'
+                        # partial sums for beta takes nblocks * ngenes adds
+                        # per factor, so use at most nnz / ngenes blocks,
+                        # where that is no more than the scatter itself.
+                        nblocks = min(_numba_num_threads(),
+                                max(1, X_csr.nnz // ngenes))
+                        beta_partial_buf = np.empty(
+                                (nblocks, ngenes, nfactors), dtype=beta.dtype)
+                    # blocks of cells with about the same number of nonzeros
+                    block_nnz = -(-Xb_csr.nnz // beta_partial_buf.shape[0])
+                    block_rows = compressed_tiles(Xb_csr.indptr,
+                            max(block_nnz, 1))
+                    tvs, bvs = compute_shape_updates_fused(Xb_csr.data,
+                            Xb_csr.indices, Xb_csr.indptr,
+                            theta_e_logx, beta_e_logx, a, c,
+                            block_rows, beta_partial_buf)
 
             if beta_theta_simultaneous:
                 # calculate gene updates but don't assign yet
                 if not freeze_genes:
-                    bvs = compute_loading_shape_update(Xphi_data,
-                            X_batch.col, ngenes, c)
-                    bvr = compute_loading_rate_update(eta.vi_shape,
-                            eta.vi_rate, theta.vi_shape[batch_ix],
-                            theta.vi_rate[batch_ix])
+                    if batched:
+                        # sums are over the last batch, not this one
+                        _, theta_e_x_factor_sums = e_x_sums(
+                                theta.vi_shape[batch_ix],
+                                theta.vi_rate[batch_ix])
+                    bvr = eta.cached_e_x()[:,None] + theta_e_x_factor_sums
                 # cell updates
-                theta.vi_shape[batch_ix] = compute_loading_shape_update(
-                        Xphi_data, X_batch.row, batchsize, a)
-                theta.vi_rate[batch_ix] = compute_loading_rate_update(
-                        xi.vi_shape[batch_ix], xi.vi_rate[batch_ix],
-                        beta.vi_shape, beta.vi_rate)
-                xi.vi_rate[batch_ix] = bp + theta.e_x[batch_ix].sum(1)
+                theta_e_x_factor_sums = update_cells(batch_ix, tvs)
                 # make gene updates
                 if not freeze_genes:
-                    beta.vi_shape = bvs
-                    beta.vi_rate = bvr
-                    eta.vi_rate = dp + beta.e_x.sum(1)
+                    beta.vi_shape[:] = bvs
+                    beta.vi_rate[:] = bvr
+                    beta._invalidate()
+                    beta_e_x_gene_sums, beta_e_x_factor_sums = \
+                            e_x_sums(beta.vi_shape, beta.vi_rate)
+                    np.add(beta_e_x_gene_sums, dp, out=eta.vi_rate)
+                    eta._invalidate()
 
             else:
                 if batched:
                     # cell updates, must do first for batching
-                    theta.vi_shape[batch_ix] = compute_loading_shape_update(
-                            Xphi_data, X_batch.row, batchsize, a)
-                    theta.vi_rate[batch_ix] = compute_loading_rate_update(
-                            xi.vi_shape[batch_ix], xi.vi_rate[batch_ix],
-                            beta.vi_shape, beta.vi_rate)
-                    xi.vi_rate[batch_ix] = bp + theta.e_x[batch_ix].sum(1)
+                    theta_e_x_factor_sums = update_cells(batch_ix, tvs)
 
                 if not freeze_genes:
                     #gene updates
-                    beta.vi_shape = compute_loading_shape_update(Xphi_data,
-                            X_batch.col, ngenes, c)
-                    beta.vi_rate = compute_loading_rate_update(eta.vi_shape,
-                            eta.vi_rate, theta.vi_shape[batch_ix],
-                            theta.vi_rate[batch_ix])
-                    eta.vi_rate = dp + beta.e_x.sum(1)
+                    beta.vi_shape[:] = bvs
+                    np.add(eta.cached_e_x()[:,None], theta_e_x_factor_sums,
+                            out=beta.vi_rate)
+                    beta._invalidate()
+                    beta_e_x_gene_sums, beta_e_x_factor_sums = \
+                            e_x_sums(beta.vi_shape, beta.vi_rate)
+                    np.add(beta_e_x_gene_sums, dp, out=eta.vi_rate)
+                    eta._invalidate()
 
                 if not batched:
                     # cell updates, doing after gene updates when not batched
                     # for legacy consistency
-                    theta.vi_shape[batch_ix] = compute_loading_shape_update(
-                            Xphi_data, X_batch.row, batchsize, a)
-                    theta.vi_rate[batch_ix] = compute_loading_rate_update(
-                            xi.vi_shape[batch_ix], xi.vi_rate[batch_ix],
-                            beta.vi_shape, beta.vi_rate)
-                    xi.vi_rate[batch_ix] = bp + theta.e_x[batch_ix].sum(1)
-
+                    theta_e_x_factor_sums = update_cells(batch_ix, tvs)
 
             # record llh/percent change and check for convergence
             if t % check_freq == 0:
@@ -724,8 +960,6 @@ class scHPF(BaseEstimator):
                                 a=a, ap=ap, bp=bp, c=c, cp=cp, dp=dp,
                                 xi=xi, eta=eta, theta=theta, beta=beta)
                     unsmoothed_loss.append(curr)
-                    if len(unsmoothed_loss) > loss_smoothing:
-                        unsmoothed_loss = unsmoothed_loss[1:]
                     # normally this is just curr as loss_smoothing=1 by default
                     loss.append(np.mean(unsmoothed_loss))
                 except NameError as e:
@@ -735,7 +969,7 @@ class scHPF(BaseEstimator):
                 # calculate percent change
                 try:
                     curr, prev = loss[-1], loss[-2]
-                    pct_change.append(100 * (curr - prev) / np.abs(prev))
+                    pct_change.append(100 * (curr - prev) / abs(prev))
                 except IndexError:
                     pct_change.append(100)
                 if verbose:
@@ -749,11 +983,11 @@ class scHPF(BaseEstimator):
                 # check convergence
                 if len(loss) > 3 and t >= min_iter:
                     # convergence conditions (all must be met)
-                    current_small = np.abs(pct_change[-1]) < self.epsilon
-                    prev_small = np.abs(pct_change[-2]) < self.epsilon
+                    current_small = abs(pct_change[-1]) < epsilon
+                    prev_small = abs(pct_change[-2]) < epsilon
                     not_inflection = not (
-                            (np.abs(loss[-3]) < np.abs(prev)) \
-                            and (np.abs(prev) > np.abs(curr)))
+                            (abs(loss[-3]) < abs(prev)) \
+                            and (abs(prev) > abs(curr)))
                     converged = current_small and prev_small and not_inflection
                     if converged:
                         if verbose:
@@ -762,21 +996,22 @@ class scHPF(BaseEstimator):
 
                     # getting worse, and has been for better_than_n_ago checks
                     # (don't waste time on a bad run)
-                    if len(loss) > self.better_than_n_ago \
-                            and self.better_than_n_ago:
-                        nprev = loss[-self.better_than_n_ago] \
-                                if len(loss)>self.better_than_n_ago else loss[0]
-                        worse_than_n_ago = np.abs(nprev) < np.abs(curr)
-                        getting_worse = np.abs(prev) < np.abs(curr)
+                    if len(loss) > better_than_n_ago and better_than_n_ago:
+                        nprev = loss[-better_than_n_ago] \
+                                if len(loss)>better_than_n_ago else loss[0]
+                        worse_than_n_ago = abs(nprev) < abs(curr)
+                        getting_worse = abs(prev) < abs(curr)
                         if worse_than_n_ago and getting_worse:
                             if verbose:
                                 print('getting worse break')
                             break
 
             # TODO message or warning or something
-            if t >= self.max_iter:
+            if t >= max_iter:
                 break
 
+        for dist in [xi, eta, theta, beta]:
+            dist._release()
         return (bp, dp, xi, eta, theta, beta, loss)
 
 
@@ -785,7 +1020,7 @@ class scHPF(BaseEstimator):
 
         Parameters
         ----------
-        X: coo_matrix
+        X: coo_matrix or csr_matrix
             Data to fit
         freeze_genes: bool, optional (Default: False)
             Should we update gene variational distributions eta and beta
@@ -849,7 +1084,7 @@ class scHPF(BaseEstimator):
 
         Parameters
         ----------
-        X : coo_matrix
+        X : coo_matrix or csr_matrix
             Data to fit
 
         Returns
@@ -860,7 +1095,23 @@ class scHPF(BaseEstimator):
         bp, dp = self.bp, self.dp
         # empirically set bp and dp
         def mean_var_ratio(X, axis):
-            axis_sum = X.sum(axis=axis)
+            # sum over nonzeros directly, rather than via scipy's np.matrix
+            if X.format == 'coo':
+                ix = X.row if axis==1 else X.col
+                axis_sum = np.bincount(ix, weights=X.data,
+                        minlength=X.shape[1-axis])
+            else:
+                X = X.tocsr()
+                if axis==1:
+                    # rows are contiguous, so sum each nonempty row's segment
+                    axis_sum = np.zeros(X.shape[0])
+                    nonempty = np.diff(X.indptr) > 0
+                    if np.any(nonempty):
+                        axis_sum[nonempty] = np.add.reduceat(X.data,
+                                X.indptr[:-1][nonempty], dtype=np.float64)
+                else:
+                    axis_sum = np.bincount(X.indices, weights=X.data,
+                            minlength=X.shape[1])
             return np.mean(axis_sum) / np.var(axis_sum)
         if bp is None:
             bp = self.ap * mean_var_ratio(X, axis=1)
@@ -892,6 +1143,43 @@ class scHPF(BaseEstimator):
         self.beta = beta
 
 
+def _numba_num_threads():
+    """Number of threads numba's parallel kernels will use
+
+    Less than numba.config.NUMBA_NUM_THREADS after numba.set_num_threads.
+    Falls back to the config value for numba versions without
+    get_num_threads.
+    """
+    if hasattr(numba, 'get_num_threads'):
+        return numba.get_num_threads()
+    return numba.config.NUMBA_NUM_THREADS
+
+
+def _counts_as_int32(X):
+    """Convert a sparse matrix of counts to int32
+
+    Parameters
+    ----------
+    X : sparse matrix
+        Data that may have a wider dtype (eg int64 or float64)
+
+    Returns
+    -------
+    X_int32 : sparse matrix
+        `X` with int32 data if its values are integers that fit in an int32,
+        otherwise `X` unchanged
+    """
+    if X.dtype == np.int32 or X.nnz == 0:
+        return X
+    if not np.issubdtype(X.dtype, np.integer) \
+            and not np.all(np.mod(X.data, 1) == 0):
+        return X
+    int32_info = np.iinfo(np.int32)
+    if X.data.min() < int32_info.min or X.data.max() > int32_info.max:
+        return X
+    return X.astype(np.int32)
+
+
 def load_model(file_name):
     """Load a model from a joblib file
 
@@ -1064,7 +1352,8 @@ def run_trials(X, nfactors,
         print(msg)
 
     # get the loss function for any data
-    if loss_function is None:
+    default_loss = loss_function is None
+    if default_loss:
         loss_function = partial(ls.mean_negative_pois_llh,
                 single_process=False)
 
@@ -1076,7 +1365,12 @@ def run_trials(X, nfactors,
     else:
         vX = X
     # setup loss fnc w/data (will be overridden if vcells is not None)
-    data_loss_function = ls.loss_function_for_data(loss_function, vX)
+    if default_loss and vcells is None:
+        # sums log(vX!) once, rather than at every check
+        data_loss_function = ls.mean_negative_pois_llh_for_data(vX,
+                single_process=False)
+    else:
+        data_loss_function = ls.loss_function_for_data(loss_function, vX)
     # setup smoothed_loss if using batches
 
     # run trials
@@ -1253,7 +1547,8 @@ def run_trials_pool(X, nfactors,
         print(msg)
 
     # get the loss function for any data
-    if loss_function is None:
+    default_loss = loss_function is None
+    if default_loss:
         loss_function = partial(ls.mean_negative_pois_llh,
                 single_process=True)
 
@@ -1265,7 +1560,12 @@ def run_trials_pool(X, nfactors,
     else:
         vX = X
     # setup loss fnc w/data (will be overridden if vcells is not None)
-    data_loss_function = ls.loss_function_for_data(loss_function, vX)
+    if default_loss and vcells is None:
+        # sums log(vX!) once, rather than at every check
+        data_loss_function = ls.mean_negative_pois_llh_for_data(vX,
+                single_process=True)
+    else:
+        data_loss_function = ls.loss_function_for_data(loss_function, vX)
 
     # only need to create once because will be copied to processes
     # override the loss function data if we have vcells
@@ -229,3 +229,52 @@ def minibatch_ix_generator(ncells, batchsize):
             res = ixs[start:stop]
         start = stop % ncells # need mod for case where ncells=batchsize
         yield res
+
+
+def canonical_csr(X):
+    """Get a sparse matrix in CSR format with sorted indices and no
+    duplicates
+
+    Parameters
+    ----------
+    X : sparse matrix
+        Matrix to convert. Not modified.
+
+    Returns
+    -------
+    X_csr : csr_matrix
+        `X` with nonzero values ordered by row. `X` itself if it is already
+        a CSR matrix in canonical format.
+    """
+    X_csr = X.tocsr()
+    if not X_csr.has_canonical_format:
+        # sum_duplicates sorts indices in place, so don't modify the
+        # caller's matrix when X is already CSR
+        if X_csr is X:
+            X_csr = X_csr.copy()
+        X_csr.sum_duplicates()
+    return X_csr
+
+
+def compressed_tiles(indptr, tile_nnz):
+    """Split the rows of a compressed matrix into contiguous blocks with
+    about `tile_nnz` nonzero values each
+
+    Parameters
+    ----------
+    indptr : ndarray
+        Index pointers of a csr_matrix (or csc_matrix, for columns)
+    tile_nnz : int
+        Target number of nonzero values per block. Blocks never split a
+        row, so they may be larger if a row has many nonzero values.
+
+    Returns
+    -------
+    boundaries : ndarray
+        Increasing row indices starting at 0 and ending at the number of
+        rows, such that block i is rows boundaries[i] to boundaries[i+1]
+    """
+    nrows, nnz = len(indptr) - 1, indptr[-1]
+    # first row starting at or after each multiple of tile_nnz
+    starts = np.searchsorted(indptr, np.arange(tile_nnz, nnz, tile_nnz))
+    return np.unique(np.concatenate([[0], starts, [nrows]]))
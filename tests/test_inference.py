@@ -1,13 +1,18 @@
 #!/usr/bin/env python
 
+from copy import deepcopy
+
 import numpy as np
-from scipy.sparse import coo_matrix
+from scipy.sparse import coo_matrix, csr_matrix
 from scipy.special import logsumexp, digamma, gammaln
 
 import pytest
-from numpy.testing import assert_allclose
+from numpy.testing import assert_allclose, assert_equal
 
 from schpf import hpf_numba, scHPF
+import schpf.loss as ls
+from schpf.util import minibatch_ix_generator, compressed_tiles
+import schpf.scHPF_ as scHPF_module
 
 # globals & seed
 np.random.seed(42)
@@ -55,6 +60,35 @@ def test_compute_Xphi_numba(data, model):
             hpf_numba.compute_Xphi_data_numpy(data, model.theta, model.beta),
             Xphi,
             rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
+    out = np.empty_like(Xphi, dtype=model.dtype)
+    assert_allclose(
+            hpf_numba.compute_Xphi_data_numpy(data, model.theta, model.beta,
+                out=out),
+            Xphi,
+            rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
+    assert_allclose(out, Xphi,
+            rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
+
+
+def test_compute_Xphi_numpy_csr(data, model):
+    X_csr = data.tocsr()
+    X_coo = X_csr.tocoo() # coo in csr order
+    reference = hpf_numba.compute_Xphi_data(X_coo.data, X_coo.row, X_coo.col,
+            model.theta.vi_shape, model.theta.vi_rate,
+            model.beta.vi_shape, model.beta.vi_rate)
+    assert_allclose(
+            hpf_numba.compute_Xphi_data_numpy(X_csr, model.theta, model.beta),
+            reference,
+            rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
+    # a block of rows, from views of the csr arrays
+    r0, r1 = 10, 50
+    p0, p1 = X_csr.indptr[r0], X_csr.indptr[r1]
+    assert_allclose(
+            hpf_numba.compute_Xphi_data_numpy_csr(X_csr.data[p0:p1],
+                X_csr.indices[p0:p1], X_csr.indptr[r0:r1+1] - p0,
+                model.theta, model.beta, theta_ix=slice(r0, r1)),
+            reference[p0:p1],
+            rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
 
 
 def test_compute_theta_shape_numba(model, Xphi, data):
@@ -90,22 +124,41 @@ def test_compute_beta_shape_numba(model, Xphi, data):
 
 def test_compute_theta_rate_numba(model):
     reference = model.xi.e_x[:,None] + model.beta.e_x.sum(0)[None,:]
-    assert_allclose(
-            hpf_numba.compute_loading_rate_update(
-                model.xi.vi_shape, model.xi.vi_rate,
-                model.beta.vi_shape, model.beta.vi_rate),
-            reference
-            )
+    rate = hpf_numba.compute_loading_rate_update(
+            model.xi.vi_shape, model.xi.vi_rate,
+            model.beta.vi_shape, model.beta.vi_rate)
+    assert_allclose(rate, reference)
+    # agrees with the update in _fit, from compute_e_x_sums
+    _, beta_e_x_factor_sums = hpf_numba.compute_e_x_sums(
+            model.beta.vi_shape, model.beta.vi_rate)
+    assert_allclose(rate, model.xi.e_x[:,None] + beta_e_x_factor_sums,
+            rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
 
 
 def test_compute_eta_rate_numba(model):
     reference = model.beta.e_x.sum(axis=1) + model.dp
-    assert_allclose(
-            hpf_numba.compute_capacity_rate_update(
-                model.beta.vi_shape, model.beta.vi_rate,
-                model.dp),
-            reference,
+    rate = hpf_numba.compute_capacity_rate_update(
+            model.beta.vi_shape, model.beta.vi_rate, model.dp)
+    assert_allclose(rate, reference,
             rtol=1e-6 if model.dtype==np.float32 else 1e-7, atol=0)
+    # agrees with the update in _fit, from compute_e_x_sums
+    beta_e_x_gene_sums, _ = hpf_numba.compute_e_x_sums(
+            model.beta.vi_shape, model.beta.vi_rate)
+    assert_allclose(rate, beta_e_x_gene_sums + model.dp,
+            rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
+
+
+@pytest.mark.parametrize('nchunks', [1, 7, 64])
+def test_compute_e_x_sums_numba(model, nchunks):
+    for e_x_sums in [hpf_numba.compute_e_x_sums,
+            hpf_numba.compute_e_x_sums_serial]:
+        item_sums, factor_sums = e_x_sums(
+                model.beta.vi_shape, model.beta.vi_rate, nchunks)
+        assert_equal(item_sums.dtype, model.dtype)
+        assert_allclose(item_sums, model.beta.e_x.sum(axis=1),
+                rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
+        assert_allclose(factor_sums, model.beta.e_x.sum(axis=0),
+                rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
 
 
 def test_llh_pois(data, model):
@@ -119,5 +172,281 @@ def test_llh_pois(data, model):
                 model.beta.vi_shape, model.beta.vi_rate),
             desired,
             rtol=1e-6 if model.dtype==np.float32 else 1e-7, atol=0)
+    assert_allclose(
+            hpf_numba.compute_pois_llh_serial(data.data, data.row, data.col,
+                model.theta.vi_shape, model.theta.vi_rate,
+                model.beta.vi_shape, model.beta.vi_rate),
+            desired,
+            rtol=1e-6 if model.dtype==np.float32 else 1e-7, atol=0)
+    log_factorial = gammaln(np.arange(data.data.max() + 1) + 1)
+    assert_allclose(
+            hpf_numba.compute_pois_llh_table(data.data, data.row, data.col,
+                model.theta.vi_shape, model.theta.vi_rate,
+                model.beta.vi_shape, model.beta.vi_rate, log_factorial),
+            desired,
+            rtol=1e-6 if model.dtype==np.float32 else 1e-7, atol=0)
+
+
+@pytest.mark.parametrize('single_process', [False, True])
+def test_llh_pois_empty(model, single_process):
+    X = coo_matrix((model.ncells, model.ngenes), dtype=np.int32)
+    llh = ls.pois_llh_pointwise(X, theta=model.theta, beta=model.beta,
+            single_process=single_process)
+    assert_equal(llh.shape, (0,))
+
+
+def test_llh_pois_large_count(data, model):
+    X = data.astype(np.int64)
+    X.data[0] = 10**9
+    desired = hpf_numba.compute_pois_llh(X.data.astype(np.float64), X.row,
+            X.col, model.theta.vi_shape, model.theta.vi_rate,
+            model.beta.vi_shape, model.beta.vi_rate)
+    assert_allclose(
+            ls.pois_llh_pointwise(X, theta=model.theta, beta=model.beta),
+            desired,
+            rtol=1e-6 if model.dtype==np.float32 else 1e-7, atol=0)
+
+
+def test_compute_loading_shape_compressed_numba(model, data):
+    X_csr = data.tocsr()
+    X_csc = X_csr.tocsc()
+    # permutation taking nonzero values in csr order to csc order
+    csr2csc = csr_matrix((np.arange(X_csr.nnz), X_csr.indices, X_csr.indptr),
+            shape=X_csr.shape).tocsc().data
+    X_coo = X_csr.tocoo() # coo in csr order
+    random_phi = np.random.dirichlet( np.ones(model.nfactors),
+            X_csr.nnz).astype(model.dtype)
+    Xphi = X_csr.data[:,None] * random_phi
+    # theta
+    assert_allclose(
+            hpf_numba.compute_loading_shape_update_compressed(
+                Xphi, X_csr.indptr, model.a),
+            hpf_numba.compute_loading_shape_update(
+                Xphi, X_coo.row, model.ncells, model.a),
+            rtol=1e-6 if model.dtype==np.float32 else 1e-7, atol=0)
+    # beta
+    assert_allclose(
+            hpf_numba.compute_loading_shape_update_compressed(
+                Xphi[csr2csc], X_csc.indptr, model.c),
+            hpf_numba.compute_loading_shape_update(
+                Xphi, X_coo.col, model.ngenes, model.c),
+            rtol=1e-6 if model.dtype==np.float32 else 1e-7, atol=0)
+    # serial
+    assert_allclose(
+            hpf_numba.compute_loading_shape_update_compressed_serial(
+                Xphi, X_csr.indptr, model.a),
+            hpf_numba.compute_loading_shape_update_compressed(
+                Xphi, X_csr.indptr, model.a))
+
+
+def test_compute_loading_shape_fused_numba(model, data):
+    X_csr = data.tocsr()
+    X_csc = X_csr.tocsc()
+    theta_e_logx = hpf_numba.compute_e_logx(model.theta.vi_shape,
+            model.theta.vi_rate)
+    beta_e_logx = hpf_numba.compute_e_logx(model.beta.vi_shape,
+            model.beta.vi_rate)
+    assert_allclose(theta_e_logx, model.theta.e_logx,
+            rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
+    assert_allclose(beta_e_logx, model.beta.e_logx,
+            rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
+
+    X_coo = X_csr.tocoo() # coo in csr order
+    Xphi = hpf_numba.compute_Xphi_data(X_coo.data, X_coo.row, X_coo.col,
+            model.theta.vi_shape, model.theta.vi_rate,
+            model.beta.vi_shape, model.beta.vi_rate)
+    # theta
+    theta_shape = hpf_numba.compute_loading_shape_update_fused(
+            X_csr.data, X_csr.indices, X_csr.indptr,
+            theta_e_logx, beta_e_logx, model.a)
+    assert_equal(theta_shape.dtype, model.dtype)
+    assert_allclose(theta_shape,
+            hpf_numba.compute_loading_shape_update_compressed(
+                Xphi, X_csr.indptr, model.a),
+            rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
+    # beta
+    assert_allclose(
+            hpf_numba.compute_loading_shape_update_fused(
+                X_csc.data, X_csc.indices, X_csc.indptr,
+                beta_e_logx, theta_e_logx, model.c),
+            hpf_numba.compute_loading_shape_update(
+                Xphi, X_coo.col, model.ngenes, model.c),
+            rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
+
+
+@pytest.mark.parametrize('nblocks', [1, 7])
+def test_compute_shape_updates_fused_numba(model, data, nblocks):
+    X_csr = data.tocsr()
+    X_coo = X_csr.tocoo() # coo in csr order
+    Xphi = hpf_numba.compute_Xphi_data(X_coo.data, X_coo.row, X_coo.col,
+            model.theta.vi_shape, model.theta.vi_rate,
+            model.beta.vi_shape, model.beta.vi_rate)
+    block_rows = compressed_tiles(X_csr.indptr, -(-X_csr.nnz // nblocks))
+    assert_equal(len(block_rows) - 1, nblocks)
+    # reused buffer with stale values
+    beta_partial = np.full((nblocks, model.ngenes, model.nfactors), np.nan,
+            dtype=model.dtype)
+    for _ in range(2):
+        theta_shape, beta_shape = hpf_numba.compute_shape_updates_fused(
+                X_csr.data, X_csr.indices, X_csr.indptr,
+                model.theta.e_logx, model.beta.e_logx, model.a, model.c,
+                block_rows, beta_partial)
+    with pytest.raises(ValueError):
+        hpf_numba.compute_shape_updates_fused(
+                X_csr.data, X_csr.indices, X_csr.indptr,
+                model.theta.e_logx, model.beta.e_logx, model.a, model.c,
+                block_rows, beta_partial[:-1])
+    assert_equal(theta_shape.dtype, model.dtype)
+    assert_equal(beta_shape.dtype, model.dtype)
+    assert_allclose(theta_shape,
+            hpf_numba.compute_loading_shape_update(
+                Xphi, X_coo.row, model.ncells, model.a),
+            rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
+    assert_allclose(beta_shape,
+            hpf_numba.compute_loading_shape_update(
+                Xphi, X_coo.col, model.ngenes, model.c),
+            rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
+
+
+def test_llh_pois_sum(data, model):
+    X_csr = data.tocsr()
+    X_coo = X_csr.tocoo() # coo in csr order
+    pointwise = hpf_numba.compute_pois_llh(X_coo.data, X_coo.row, X_coo.col,
+            model.theta.vi_shape, model.theta.vi_rate,
+            model.beta.vi_shape, model.beta.vi_rate)
+    desired = np.sum(pointwise + gammaln(X_coo.data + 1))
+    for llh_sum_function in [hpf_numba.compute_pois_llh_sum,
+            hpf_numba.compute_pois_llh_sum_serial]:
+        assert_allclose(
+                llh_sum_function(X_csr.data, X_csr.indices, X_csr.indptr,
+                    model.theta.vi_shape, model.theta.vi_rate,
+                    model.beta.vi_shape, model.beta.vi_rate),
+                desired,
+                rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
+
+    # check loss is the same as the generic version
+    loss = ls.mean_negative_pois_llh_for_data(data)
+    assert_allclose(
+            loss(theta=model.theta, beta=model.beta),
+            ls.mean_negative_pois_llh(data, theta=model.theta,
+                beta=model.beta),
+            rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
+
+    # including for data with duplicate entries
+    dup = data.nnz // 2
+    X_dup = coo_matrix((np.concatenate([data.data, data.data[:dup]]),
+            (np.concatenate([data.row, data.row[:dup]]),
+             np.concatenate([data.col, data.col[:dup]]))), shape=data.shape)
+    loss = ls.mean_negative_pois_llh_for_data(X_dup)
+    assert_allclose(
+            loss(theta=model.theta, beta=model.beta),
+            ls.mean_negative_pois_llh(X_dup, theta=model.theta,
+                beta=model.beta),
+            rtol=1e-5 if model.dtype==np.float32 else 1e-7, atol=0)
+
+
+def _cavi_step_reference(model, X, batch_ix, batched, simultaneous):
+    """Variational distributions after one CAVI step of _fit from `model`,
+    with Xphi from compute_Xphi_data and expectations from HPF_Gamma"""
+    a, ap, c, cp, bp, dp = model.a, model.ap, model.c, model.cp, model.bp, \
+            model.dp
+    nfactors, ngenes = model.nfactors, model.ngenes
+    xi, eta, theta, beta = model.xi, model.eta, model.theta, model.beta
+
+    # shapes for the hierarchical priors are set before the loop
+    xi_e_x = (ap + nfactors * a) / xi.vi_rate
+    eta_e_x = (cp + nfactors * c) / eta.vi_rate
+
+    # shape updates from phi for the batch's cells
+    Xb = X.tocsr()[batch_ix].tocoo()
+    Xphi = hpf_numba.compute_Xphi_data(Xb.data, Xb.row, Xb.col,
+            theta.vi_shape[batch_ix], theta.vi_rate[batch_ix],
+            beta.vi_shape, beta.vi_rate)
+    theta_shape_b = hpf_numba.compute_loading_shape_update(Xphi, Xb.row,
+            len(batch_ix), a)
+    beta_shape = hpf_numba.compute_loading_shape_update(Xphi, Xb.col,
+            ngenes, c)
+
+    # rate updates, in the order _fit makes them
+    if not batched and not simultaneous:
+        # genes, then cells
+        beta_rate = eta_e_x[:,None] + theta.e_x[batch_ix].sum(0)
+        theta_rate_b = xi_e_x[batch_ix,None] \
+                + (beta_shape / beta_rate).sum(0)
+    else:
+        # cells, then genes with new theta if batched and not simultaneous
+        theta_rate_b = xi_e_x[batch_ix,None] + beta.e_x.sum(0)
+        theta_e_x_b = theta.e_x[batch_ix] if simultaneous \
+                else theta_shape_b / theta_rate_b
+        beta_rate = eta_e_x[:,None] + theta_e_x_b.sum(0)
+
+    theta_shape, theta_rate = theta.vi_shape.copy(), theta.vi_rate.copy()
+    theta_shape[batch_ix], theta_rate[batch_ix] = theta_shape_b, theta_rate_b
+    xi_rate = xi.vi_rate.copy()
+    xi_rate[batch_ix] = bp + (theta_shape_b / theta_rate_b).sum(1)
+    eta_rate = dp + (beta_shape / beta_rate).sum(1)
+    return dict(theta_shape=theta_shape, theta_rate=theta_rate,
+            xi_rate=xi_rate, beta_shape=beta_shape, beta_rate=beta_rate,
+            eta_rate=eta_rate)
+
+
+@pytest.mark.parametrize('single_process', [False, True])
+@pytest.mark.parametrize('simultaneous', [False, True])
+@pytest.mark.parametrize('batchsize', [None, 100])
+def test_fit_step(data, model, batchsize, simultaneous, single_process,
+        monkeypatch):
+    # several blocks of Xphi_data when single_process
+    monkeypatch.setattr(scHPF_module, '_XPHI_TILE_NNZ', 500)
+    batched = batchsize is not None
+    initial = deepcopy(model)
+
+    rng_state = np.random.get_state()
+    bp, dp, xi, eta, theta, beta, loss = model._fit(data, reinit=False,
+            max_iter=1, check_freq=1, verbose=False, batchsize=batchsize,
+            beta_theta_simultaneous=simultaneous,
+            single_process=single_process)
+    if batched:
+        # replay the batch _fit drew
+        np.random.set_state(rng_state)
+        batch_ix = next(minibatch_ix_generator(model.ncells, batchsize))
+    else:
+        batch_ix = np.arange(model.ncells)
+
+    desired = _cavi_step_reference(initial, data, batch_ix, batched,
+            simultaneous)
+    actual = dict(theta_shape=theta.vi_shape, theta_rate=theta.vi_rate,
+            xi_rate=xi.vi_rate, beta_shape=beta.vi_shape,
+            beta_rate=beta.vi_rate, eta_rate=eta.vi_rate)
+    for name in desired:
+        assert_allclose(actual[name], desired[name],
+                rtol=1e-4 if model.dtype==np.float32 else 1e-10, atol=0,
+                err_msg=name)
+
+
+def test_fit_random_first_step(data, model, monkeypatch):
+    # several blocks of random Xphi_data
+    monkeypatch.setattr(scHPF_module, '_XPHI_TILE_NNZ', 500)
+    bp, dp, xi, eta, theta, beta, loss = model._fit(data, reinit=True,
+            max_iter=1, check_freq=1, verbose=False)
+    # phi sums to one over factors, so shapes sum to the data's totals
+    X_csr = data.tocsr()
+    assert_allclose(theta.vi_shape.sum(1),
+            model.nfactors * model.a + np.asarray(X_csr.sum(1)).ravel(),
+            rtol=1e-5 if model.dtype==np.float32 else 1e-10)
+    assert_allclose(beta.vi_shape.sum(1),
+            model.nfactors * model.c + np.asarray(X_csr.sum(0)).ravel(),
+            rtol=1e-5 if model.dtype==np.float32 else 1e-10)
 
 
+def test_fit_after_inplace_modification(data, model):
+    model.beta.cached_e_logx()
+    model.beta.vi_shape[:] *= 3
+    # copies don't keep cached values
+    desired = deepcopy(model)
+    _, _, _, _, theta, _, loss = model._fit(data, freeze_genes=True,
+            reinit=False, max_iter=1, check_freq=1, verbose=False)
+    _, _, _, _, desired_theta, _, desired_loss = desired._fit(data,
+            freeze_genes=True, reinit=False, max_iter=1, check_freq=1,
+            verbose=False)
+    assert_allclose(theta.vi_shape, desired_theta.vi_shape)
+    assert_allclose(loss, desired_loss)
@@ -1,12 +1,16 @@
 #!/usr/bin/env python
 
 import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.special import digamma, gammaln
 
 import pytest
-from numpy.testing import assert_equal
+from numpy.testing import assert_equal, assert_allclose
 from numpy.testing import assert_array_equal
 
 from schpf import HPF_Gamma, scHPF, combine_across_cells
+from schpf import load_model, save_model
+from schpf.scHPF_ import _counts_as_int32
 
 """For tests of inference, see test_inference.py
 """
@@ -21,6 +25,11 @@ def test__setup_meanvar(model_uninit, data):
     assert_equal(bp, np.mean(cell_sums) / np.var(cell_sums))
     assert_equal(dp, np.mean(gene_sums) / np.var(gene_sums))
 
+    # same from csr
+    bp_csr, dp_csr = model_uninit._get_empirical_hypers(data.tocsr())
+    assert_allclose(bp_csr, bp)
+    assert_allclose(dp_csr, dp)
+
 
 def test__setup_dims(model_uninit, data):
     bp, dp, xi, eta, theta, beta = model_uninit._setup(X=data,
@@ -87,6 +96,107 @@ def test__set_ac(model_uninit):
     model_uninit.c = -2
     assert model_uninit.c == 1/np.sqrt(15)
 
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_HPF_Gamma_cached_e_logx(dtype):
+    a = HPF_Gamma.random_gamma_factory((5,10), 0.3, 1.0, dtype=dtype)
+    e_logx = a.cached_e_logx()
+    assert_array_equal(e_logx, a.e_logx)
+    assert a.cached_e_logx() is e_logx
+
+    # setting invalidates
+    a.vi_rate = 2 * a.vi_rate
+    assert_array_equal(a.cached_e_logx(), a.e_logx)
+    # modifying in place requires _invalidate
+    a.vi_shape[0] = 1.0
+    a._invalidate()
+    assert_array_equal(a.cached_e_logx(), a.e_logx)
+    assert a.cached_e_logx() is e_logx # recomputed in the same buffer
+
+    e_x = a.cached_e_x()
+    assert_array_equal(e_x, a.e_x)
+    a.vi_shape = 2 * a.vi_shape
+    assert_array_equal(a.cached_e_x(), a.e_x)
+
+
+def test__counts_as_int32():
+    row, col = np.array([0, 1, 2]), np.array([1, 0, 2])
+    def counts(data):
+        return coo_matrix((np.array(data), (row, col)), shape=(3, 3))
+
+    # integers and whole-number floats are converted
+    for X in [counts([1, 5, 2**31 - 1]), counts([1.0, 5.0, 3.0])]:
+        X_int32 = _counts_as_int32(X)
+        assert_equal(X_int32.dtype, np.int32)
+        assert_array_equal(X_int32.toarray(), X.toarray())
+    # int32 data is used as is
+    X = counts(np.array([1, 2, 3], dtype=np.int32))
+    assert _counts_as_int32(X) is X
+    # non-integer floats and values that don't fit in an int32 are unchanged
+    for X in [counts([1.0, 2.5, 3.0]), counts([1, 2, 2**31]),
+              counts([1.0, 2.0, 1e10])]:
+        assert _counts_as_int32(X) is X
+    # empty matrices
+    X = coo_matrix((3, 3), dtype=np.int64)
+    X_int32 = _counts_as_int32(X)
+    assert_equal(X_int32.nnz, 0)
+    assert_equal(X_int32.shape, (3, 3))
+
+
+def test_HPF_Gamma_state():
+    a = HPF_Gamma.random_gamma_factory((5,10), 0.3, 1.0)
+    a.cached_e_logx()
+    # same keys as when vi_shape and vi_rate were plain attributes
+    state = a.__getstate__()
+    assert_equal(sorted(state.keys()), ['dtype', 'vi_rate', 'vi_shape'])
+
+    # load a state saved by an older version
+    b = HPF_Gamma.__new__(HPF_Gamma)
+    b.__setstate__(dict(vi_shape=a.vi_shape.copy(), vi_rate=a.vi_rate.copy(),
+        dtype=a.dtype))
+    assert_equal(b, a)
+    assert_array_equal(b.cached_e_logx(), a.e_logx)
+
+
+def test_save_load_model(model, tmp_path):
+    model.theta.cached_e_logx()
+    file_name = str(tmp_path / 'model.joblib')
+    save_model(model, file_name)
+    loaded = load_model(file_name)
+    for name in ['xi', 'eta', 'theta', 'beta']:
+        assert_equal(getattr(loaded, name), getattr(model, name))
+    assert_array_equal(loaded.theta.cached_e_logx(), model.theta.e_logx)
+
+
+def test__fit_releases_cached(model, data):
+    bp, dp, xi, eta, theta, beta, loss = model._fit(data, max_iter=2,
+            check_freq=1, verbose=False)
+    for dist in [xi, eta, theta, beta]:
+        assert not hasattr(dist, '_e_x_buf')
+        assert not hasattr(dist, '_e_logx_buf')
+        # still usable
+        assert_array_equal(dist.cached_e_logx(), dist.e_logx)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_HPF_Gamma_entropy(dtype):
+    a = HPF_Gamma.random_gamma_factory((5,10), 0.3, 1.0, dtype=dtype)
+    vi_shape, vi_rate = a.vi_shape, a.vi_rate
+    reference = vi_shape - np.log(vi_rate) + gammaln(vi_shape) \
+            + (1 - vi_shape) * digamma(vi_shape)
+    assert_allclose(a.entropy, reference,
+            rtol=1e-5 if dtype==np.float32 else 1e-7)
+
+
+@pytest.mark.parametrize('a_dims', [(5,), (5,10)])
+def test_HPF_Gamma_sample(a_dims):
+    a = HPF_Gamma.random_gamma_factory(a_dims, 0.3, 1.0)
+    assert_equal(a.sample().shape, a_dims + (1,))
+    samples = a.sample(5000)
+    assert_equal(samples.shape, a_dims + (5000,))
+    # check samples for each distribution follow that distribution
+    assert np.all(np.abs(samples.mean(-1) - a.e_x) < 0.2 * a.e_x)
+
+
 @pytest.mark.parametrize('a_dims', [[5,], [5,10]])
 @pytest.mark.parametrize('dtype', [np.float64, np.float32])
 def test_HPF_Gamma_combine(a_dims, dtype):
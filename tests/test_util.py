@@ -2,11 +2,12 @@
 
 import numpy as np
 from numpy.testing import assert_equal, assert_array_equal
-from scipy.sparse import coo_matrix
+from scipy.sparse import coo_matrix, csr_matrix
 import pytest
 
 from schpf import max_pairwise, max_pairwise_table
 from schpf.util import split_coo_rows, collapse_coo_rows, insert_coo_rows
+from schpf.util import canonical_csr, compressed_tiles
 from schpf.util import mean_cellscore_fraction
 
 
@@ -131,3 +132,28 @@ def test_insert_coo_rows():
         insert_coo_rows(a, b, b_indices)
     assert "must be ordered" in str(execinfo.value)
 
+
+def test_canonical_csr_unsorted():
+    # int32 csr with unsorted indices and a duplicate in row 0
+    indptr = np.array([0, 3, 4])
+    indices = np.array([2, 0, 2, 1])
+    data = np.array([1, 2, 3, 4], dtype=np.int32)
+    X = csr_matrix((data, indices, indptr), shape=(2, 3))
+
+    X_csr = canonical_csr(X)
+    assert_array_equal(X_csr.todense(), [[2, 0, 4], [0, 4, 0]])
+    assert_array_equal(X_csr.indices, [0, 2, 1])
+    # caller's matrix is unchanged
+    assert_array_equal(X.indices, [2, 0, 2, 1])
+    assert_array_equal(X.data, [1, 2, 3, 4])
+
+
+def test_compressed_tiles():
+    # rows with 2, 0, 5, 1, 1 and 3 nonzeros
+    indptr = np.array([0, 2, 2, 7, 8, 9, 12])
+    assert_array_equal(compressed_tiles(indptr, 3), [0, 3, 5, 6])
+    assert_array_equal(compressed_tiles(indptr, 100), [0, 6])
+    # each nonempty row in its own block, empty rows merged with the next
+    assert_array_equal(compressed_tiles(indptr, 1), [0, 1, 3, 4, 5, 6])
+    # no nonzeros
+    assert_array_equal(compressed_tiles(np.zeros(4, dtype=int), 3), [0, 3])